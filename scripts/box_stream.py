@@ -11,7 +11,7 @@ Endpoints
 ---------
 /          : index with links
 /video     : MJPEG stream with detections + box count overlay
-/snapshot  : capture one frame, save original & detected JPGs into samples/
+/snapshot  : save the latest frame (original & with its detections) as JPGs into samples/
 
 Quick Start (on Raspberry Pi OS)
 --------------------------------
@@ -39,6 +39,7 @@ import sys
 import time
 import signal
 import logging
+import threading
 from datetime import datetime
 
 import cv2
@@ -46,13 +47,23 @@ import numpy as np
 from flask import Flask, Response
 from picamera2 import Picamera2
 from flask import jsonify
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from frame_pipeline import (ClientCount, FpsMeter, FrameWorker, LatestFrame, JPEG_ENCODER,
+                            encode_jpeg, mjpeg_parts, serve_app)
+
 START_TIME = time.time()
 
 PORT         = int(os.getenv("BOX_PORT", "8000"))
 JPEG_QUALITY = int(os.getenv("BOX_JPEG_QUALITY", "70"))
 RES_W        = int(os.getenv("BOX_RES_W", "1280"))
 RES_H        = int(os.getenv("BOX_RES_H", "720"))
+DETECT_CPUS  = os.getenv("BOX_DETECT_CPUS", "2,3")  # cores for the detector thread (all else uses the rest); "" = no pinning
+
+# Periodic health check: SoC temperature (the Pi 3 throttles hard once hot)
+# and camera FrameDuration (rising = frames backing up behind detection)
+HEALTH_CHECK_S = 30
+TEMP_WARN_C    = 75.0
 
 # Debounce + warm-up (tweak if needed)
 HIT_THRESHOLD  = 4      # hits in a row to turn ON
@@ -60,6 +71,17 @@ MISS_THRESHOLD = 10     # misses in a row to turn OFF
 STARTUP_WARMUP_FRAMES = 30  # ignore first ~1 second
 LATCH_FRAMES = 10  # ~1/3–1/2 s at ~20–30 FPS
 
+# Detection runs on a frame downscaled by this factor; overlays are scaled back up
+DETECT_SCALE = 2
+# Run detection on every Nth frame; the frames between reuse the last result
+# (hysteresis still counts every frame)
+DETECT_EVERY_N = 3
+
+# Motion gate: re-run find_boxes_gray only if the scene changed since the last detection
+MOTION_THUMB      = (160, 90)  # grayscale thumbnail compared frame to frame
+MOTION_DELTA      = 15         # per-pixel change that counts as motion
+MOTION_MIN_PIXELS = 50         # changed thumbnail pixels needed to re-detect
+
 print("BOX_DETECTOR MODE: threshold+largest-blob v0.3")
 
 import socket
@@ -84,6 +106,43 @@ HOST_IP = _get_ip()
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 log = logging.getLogger("box_detector")
 
+# The detector is all stock OpenCV calls; make sure its SIMD (NEON) dispatch is on
+cv2.setUseOptimized(True)
+_CPU_NEON = getattr(cv2, "CPU_NEON", 100)  # enum value isn't exported by every build
+log.info("OpenCV %s optimized=%s NEON=%s",
+         cv2.__version__, cv2.useOptimized(), cv2.checkHardwareSupport(_CPU_NEON))
+log.info("JPEG encoder: %s", JPEG_ENCODER)
+
+# OpenCL T-API for the detection filters where a device exists (Pi 4/5 or a
+# desktop test box); the Pi 3 has none, so this stays off there
+_USE_OPENCL = cv2.ocl.haveOpenCL()
+cv2.ocl.setUseOpenCL(_USE_OPENCL)
+log.info("OpenCL for detection: %s", _USE_OPENCL)
+
+# --------------------------- CPU pinning -----------------------
+def _pin_current_thread(cpus: set[int], who: str) -> None:
+    """Pin the calling thread to the CPUs in cpus (Linux only; empty = no-op)."""
+    if not cpus or not hasattr(os, "sched_setaffinity"):
+        return
+    try:
+        os.sched_setaffinity(0, cpus)
+        log.info("%s pinned to CPUs %s", who, ",".join(map(str, sorted(cpus))))
+    except OSError as e:
+        log.warning("Could not pin %s to CPUs %s: %s", who, sorted(cpus), e)
+
+try:
+    _DETECT_CPU_SET = {int(c) for c in DETECT_CPUS.split(",") if c.strip()}
+except ValueError:
+    log.warning("Ignoring invalid BOX_DETECT_CPUS=%r", DETECT_CPUS)
+    _DETECT_CPU_SET = set()
+
+# Everything but the detector (camera, capture, stream encode, HTTP) runs on
+# the remaining cores. New threads inherit their creator's affinity, so pin
+# the main thread now, before Picamera2 or any of our threads start; the
+# detector thread re-pins itself to DETECT_CPUS.
+if _DETECT_CPU_SET and hasattr(os, "sched_getaffinity"):
+    _pin_current_thread(os.sched_getaffinity(0) - _DETECT_CPU_SET, "Main/I-O threads")
+
 # --------------------------- Paths -----------------------------
 # samples/ lives one level up from this script (repo root/samples)
 SCRIPTDIR   = os.path.dirname(os.path.abspath(__file__))
@@ -94,7 +153,18 @@ os.makedirs(SAMPLES_DIR, exist_ok=True)
 picam = Picamera2()
 
 # config = picam.create_video_configuration(main={"size": (1280, 720)}, buffer_count=4)  # try (960,540) if needed
-config = picam.create_video_configuration(main={"size": (RES_W, RES_H)}, buffer_count=4)
+# Picamera2's "RGB888" is laid out B,G,R in memory, i.e. what OpenCV calls BGR,
+# so frames go straight into OpenCV without a per-frame cvtColor.
+# 8 buffers (~22 MB CMA at 720p) ride out detection stalls without dropping frames.
+# Detection gets its own ISP-scaled YUV420 "lores" stream at detection size:
+# the Y plane is the grayscale find_boxes_gray needs, so it skips the resize and
+# BGR->gray conversion (lores must be YUV on the Pi 3 ISP anyway).
+DET_W, DET_H = RES_W // DETECT_SCALE, RES_H // DETECT_SCALE
+config = picam.create_video_configuration(
+    main={"size": (RES_W, RES_H), "format": "RGB888"},
+    lores={"size": (DET_W, DET_H), "format": "YUV420"},
+    buffer_count=8, queue=True
+)
 picam.configure(config)
 picam.start()
 time.sleep(0.3)
@@ -110,17 +180,56 @@ log.info("Picamera2 started with %s", config)
 # --------------------------- App -------------------------------
 app = Flask(__name__)
 
-def draw_hud(img, fps: float | None, present: int, raw: int):
+HUD_FPS_REFRESH_S = 0.5  # hold the displayed FPS so the cached HUD sprite stays valid
+
+def _text_mask(text: str, scale: float, thickness: int):
     """
-    Overlay a small translucent panel with project info, FPS, and endpoints.
+    Rasterise text once: returns (ys, xs, alpha) for the inked pixels of a
+    sprite, its (h, w), and the (x, y) offset of the baseline origin in it.
     """
+    (tw, th), base = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+    pad = thickness + 1  # thick strokes spill past getTextSize()
+    mask = np.zeros((th + base + 2 * pad, tw + 2 * pad), np.uint8)
+    cv2.putText(mask, text, (pad, pad + th), cv2.FONT_HERSHEY_SIMPLEX, scale, 255,
+                thickness, cv2.LINE_8)
+    ys, xs = np.nonzero(mask)
+    alpha = (mask[ys, xs].astype(np.float32) / 255.0)[:, None]  # 1.0 unless the build anti-aliases
+    return (ys, xs, alpha), mask.shape, (pad, pad + th)
+
+# The whole HUD text block is one sprite, rebuilt only when a line changes
+# (about twice a second: clock + held FPS). (key, sprite), swapped as a unit.
+_HUD_SPRITE = (None, None)
+
+def _hud_sprite(shape: tuple[int, int], lines):
+    """
+    Rasterise HUD lines, given as (text, org, scale, color, thickness) in
+    sprite coords, into one (ys, xs, alpha, color) set of inked pixels,
+    clipped to shape.
+    """
+    h, w = shape
+    parts = []
+    for text, (ox, oy), scale, color, thickness in lines:
+        (ys, xs, alpha), _, (dx, dy) = _text_mask(text, scale, thickness)
+        ys, xs = ys + (oy - dy), xs + (ox - dx)
+        ok = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+        parts.append((ys[ok], xs[ok], alpha[ok],
+                      np.broadcast_to(np.float32(color), (int(ok.sum()), 3))))
+    return tuple(np.concatenate(p) for p in zip(*parts))
+
+def draw_hud(img, fps: float | None, present: int, raw: int, warming_up: bool = False):
+    """
+    Overlay a small translucent panel with project info, FPS, and endpoints
+    (plus a "Warming up..." line under it while warming_up).
+    """
+    global _HUD_SPRITE
     h, w = img.shape[:2]
 
-    # translucent panel
-    overlay = img.copy()
+    # translucent black panel: 35% black over 65% image is just a 0.65 scale,
+    # done in place on the panel ROI (no full-frame copy + blend)
     panel_h = 92
-    cv2.rectangle(overlay, (8, 8), (min(8 + int(w * 0.75), w - 8), 8 + panel_h), (0, 0, 0), -1)
-    cv2.addWeighted(overlay, 0.35, img, 0.65, 0, img)
+    x2 = min(8 + int(w * 0.75), w - 8)
+    panel = img[8:8 + panel_h + 1, 8:x2 + 1]
+    cv2.convertScaleAbs(panel, panel, 0.65)
 
     # lines
     ts = datetime.now().strftime("%H:%M:%S")
@@ -131,187 +240,372 @@ def draw_hud(img, fps: float | None, present: int, raw: int):
         line2 = f"Boxes: {present}  (raw:{raw})"
     line3 = f"http://{HOST_IP}:{PORT}/video   /snapshot   /health"
 
-    cv2.putText(img, line1, (16, 32), cv2.FONT_HERSHEY_SIMPLEX, 0.62, (255, 255, 255), 2)
-    cv2.putText(img, line2, (16, 56), cv2.FONT_HERSHEY_SIMPLEX, 0.62, (255, 255, 255), 2)
-    cv2.putText(img, line3, (16, 80), cv2.FONT_HERSHEY_SIMPLEX, 0.52, (220, 220, 220), 1)
-
-def find_boxes(frame_bgr: np.ndarray) -> tuple[np.ndarray, int]:
+    # text area: panel rows + room for the warm-up line below, from the
+    # panel's left edge to the frame edge
+    text_roi = img[8:8 + panel_h + 32, 8:w]
+    key = (text_roi.shape[:2], line1, line2, line3, warming_up)
+    cached_key, sprite = _HUD_SPRITE
+    if cached_key != key:
+        lines = [
+            (line1, (8, 24), 0.62, (255, 255, 255), 2),
+            (line2, (8, 48), 0.62, (255, 255, 255), 2),
+            (line3, (8, 72), 0.52, (220, 220, 220), 1),
+        ]
+        if warming_up:
+            lines.append(("Warming up...", (8, 100), 0.6, (255, 255, 255), 2))
+        sprite = _hud_sprite(text_roi.shape[:2], lines)
+        _HUD_SPRITE = (key, sprite)
+    ys, xs, alpha, color = sprite
+    px = text_roi[ys, xs].astype(np.float32)
+    text_roi[ys, xs] = px + (color - px) * alpha
+
+# Scratch buffers for find_boxes_gray, kept per thread: the detector thread is
+# the only caller, but CLAHE objects are not thread-safe if that ever changes
+_tls = threading.local()
+_K3 = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
+def _workspace(h: int, w: int) -> dict:
     """
-    Robust box detector:
-      1) LAB/CLAHE -> adaptive threshold (inverse)
-      2) Pad the image so objects touching frame edges close properly
-      3) Contours -> convex quad OR rotated rect
-      4) Fallback: largest blob minAreaRect if all filters fail
-    Returns (annotated_image, detection_count).
+    Return this thread's find_boxes_gray buffers (and CLAHE instance, which is not
+    thread-safe) plus the area limits for an (h, w) detection frame, set up
+    only on first use or when the size changes.
     """
-    img = frame_bgr.copy()
-    H, W = img.shape[:2]
+    ws = getattr(_tls, "ws", None)
+    if ws is None or ws["size"] != (h, w):
+        ws = {
+            "size":    (h, w),
+            "clahe":   cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)),
+            "Lc":      np.empty((h, w), np.uint8),
+            "thr":     np.empty((h, w), np.uint8),
+            # contour area limits: 1% .. 99% of the detection frame
+            "min_area": (w * h) * 0.01,
+            "max_area": (w * h) * 0.99,
+        }
+        _tls.ws = ws
+    return ws
+
+def find_boxes_gray(gray: np.ndarray, S: int = DETECT_SCALE) -> tuple[list[np.ndarray], int]:
+    """
+    Robust box detector on an 8-bit grayscale frame at 1/S of full resolution
+    (the lores Y plane):
+      1) CLAHE -> adaptive mean threshold (inverse)
+      2) Zero the mask border so objects touching frame edges close properly
+      3) Contours -> rotated rect (minAreaRect) fill check; marginal fills
+         get the convex-quad check
+      4) Fallback: largest marginal minAreaRect if nothing else passes
+    Returns (boxes, detection_count): boxes are 4x2 int32 corner arrays in
+    full-resolution coords, ready for draw_boxes(). gray is not modified;
+    intermediates live in _workspace().
+    """
+    assert gray.dtype == np.uint8 and gray.ndim == 2, (gray.dtype, gray.shape)
+    h_s, w_s = gray.shape
+    ws = _workspace(h_s, w_s)
+
+    # With OpenCL (T-API) the filter chain runs on UMats and only the final
+    # mask is downloaded for findContours; otherwise it fills ws buffers
+    ocl = _USE_OPENCL
+    src = cv2.UMat(gray) if ocl else gray
 
     # --- Contrast boost on luminance ---
-    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-    L, A, B = cv2.split(lab)
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    Lc = clahe.apply(L)
+    Lc = ws["clahe"].apply(src, dst=None if ocl else ws["Lc"])
 
     # --- Adaptive threshold (invert: object -> white) ---
+    # MEAN_C computes the local mean with a separable boxFilter, much cheaper
+    # on the Pi than the GaussianBlur behind GAUSSIAN_C. Block 15 at half
+    # resolution covers about the same scene area as the old 25 at full res.
     thr = cv2.adaptiveThreshold(
         Lc, 255,
-        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.ADAPTIVE_THRESH_MEAN_C,
         cv2.THRESH_BINARY_INV,
-        25, 7
+        15, 7,
+        dst=None if ocl else ws["thr"]
     )
-    thr = cv2.medianBlur(thr, 3)
-    thr = cv2.morphologyEx(thr, cv2.MORPH_CLOSE, None, iterations=2)
+    # No median pass: isolated specks only become tiny contours that the area
+    # cull drops. The close runs in place on the threshold buffer.
+    thr = cv2.morphologyEx(thr, cv2.MORPH_CLOSE, _K3, dst=thr, iterations=2)
+    if ocl:
+        thr = thr.get()
 
-    # --- Pad both mask and RGB so frame-touching boxes are closed ---
-    PAD = 8
-    thr_pad = cv2.copyMakeBorder(thr, PAD, PAD, PAD, PAD, cv2.BORDER_CONSTANT, value=0)
-    img_pad = cv2.copyMakeBorder(img, PAD, PAD, PAD, PAD, cv2.BORDER_REPLICATE)
+    # --- Zero a 1-px frame on the mask so frame-touching boxes are closed ---
+    thr[0, :] = 0; thr[-1, :] = 0
+    thr[:, 0] = 0; thr[:, -1] = 0
 
-    # --- Contours on padded mask ---
-    cnts, _ = cv2.findContours(thr_pad, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # --- Contours on mask ---
+    cnts, _ = cv2.findContours(thr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-    min_area = (W * H) * 0.01    # start at 1% of frame
-    max_area = (W * H) * 0.99
+    min_area, max_area = ws["min_area"], ws["max_area"]
 
-    detections = 0
-    best = None  # keep track of the largest good candidate
+    boxes = []
+    best = None  # largest marginal candidate (the first one seen)
 
-    for c in cnts:
-        area = cv2.contourArea(c)
-        if area < min_area or area > max_area:
-            continue
+    # --- Cull by area in one vectorised pass; most contours are small noise ---
+    # Survivors are visited largest first, so the fallback needs no area bookkeeping
+    areas = np.fromiter((cv2.contourArea(c) for c in cnts), dtype=np.float32, count=len(cnts))
+    keep = np.nonzero((areas >= min_area) & (areas <= max_area))[0]
+    keep = keep[np.argsort(-areas[keep], kind="stable")]
 
-        peri = cv2.arcLength(c, True)
-        approx = cv2.approxPolyDP(c, 0.015 * peri, True)
-
-        # try convex quad
-        if len(approx) == 4 and cv2.isContourConvex(approx):
-            x, y, w, h = cv2.boundingRect(approx)
-            if h == 0 or w == 0:
-                continue
-            aspect = max(w, h) / float(min(w, h))
-            rectangularity = area / (w * h)
-            if 0.2 < aspect < 6.0 and rectangularity > 0.50:
-                # unpad draw coords
-                x, y = x - PAD, y - PAD
-                cv2.rectangle(img, (x, y), (x + w, y + h), (0, 255, 0), 2)
-                detections += 1
-                continue
+    for i in keep:
+        c = cnts[i]
+        area = float(areas[i])
 
-        # rotated rectangle fallback for this contour
-        (cx, cy), (rw, rh), angle = cv2.minAreaRect(c)
+        # rotated rectangle first: one call, and it handles any orientation
+        rect = cv2.minAreaRect(c)
+        rw, rh = rect[1]
         if rw < 1 or rh < 1:
             continue
         r_area = rw * rh
         if r_area < min_area or r_area > max_area:
             continue
         aspect = max(rw, rh) / min(rw, rh)
+        if not 0.2 < aspect < 6.0:
+            continue
         rectangularity = area / r_area
-        if 0.2 < aspect < 6.0 and rectangularity > 0.45:
-            if best is None or area > best[0]:
-                best = (area, (cx, cy), (rw, rh), angle)
+        if rectangularity > 0.55:
+            boxes.append(np.int32(cv2.boxPoints(rect) * S))  # upscale
+            continue
+        if rectangularity <= 0.45:
+            continue
 
-    # draw best rotated rectangle if no quads were drawn
-    if detections == 0 and best is not None:
-        _, (cx, cy), (rw, rh), angle = best
-        box = cv2.boxPoints(((cx, cy), (rw, rh), angle))
-        box = np.int32(box - [PAD, PAD])  # unpad
-        cv2.drawContours(img, [box], 0, (0, 255, 0), 2)
-        detections = 1
+        # marginal fill (0.45-0.55): accept a clean convex quad as an
+        # axis-aligned box, otherwise keep it as a fallback candidate
+        peri = cv2.arcLength(c, True)
+        approx = cv2.approxPolyDP(c, 0.015 * peri, True)
+        if len(approx) == 4 and cv2.isContourConvex(approx):
+            x, y, w, h = cv2.boundingRect(approx)
+            if w > 0 and h > 0 and 0.2 < max(w, h) / min(w, h) < 6.0 and area / (w * h) > 0.50:
+                # scale corners back to full resolution
+                x, y, w, h = x * S, y * S, w * S, h * S
+                boxes.append(np.int32([[x, y], [x + w, y], [x + w, y + h], [x, y + h]]))
+                continue
+        if best is None:
+            best = rect
 
-    return img, detections
+    # use best marginal rotated rectangle if nothing else was found
+    if not boxes and best is not None:
+        boxes.append(np.int32(cv2.boxPoints(best) * S))  # upscale
 
+    return boxes, len(boxes)
 
 
-def mjpeg_generator():
-    """
-    MJPEG stream with warm-up + hysteresis and robust exception handling.
-    Any per-frame error is logged and the loop continues (no 500).
-    """
-    encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY]
+def draw_boxes(img: np.ndarray, boxes: list[np.ndarray]) -> np.ndarray:
+    """Draw find_boxes_gray() results onto img in place."""
+    if boxes:
+        cv2.polylines(img, boxes, True, (0, 255, 0), 2)
+    return img
 
-    present = False
-    hits = 0
-    misses = 0
-    frame_i = 0
 
-    fps_intervals = deque(maxlen=15)
-    last_t = time.time()
+def _thumb(gray: np.ndarray) -> np.ndarray:
+    """Tiny copy of the grayscale detection frame for the motion gate."""
+    return cv2.resize(gray, MOTION_THUMB, interpolation=cv2.INTER_AREA)
 
-    while True:
-        try:
-            # --- capture ---
-            frame_rgb = picam.capture_array()
-            frame_bgr = cv2.cvtColor(frame_rgb, cv2.COLOR_RGB2BGR)
+def _moved(prev: np.ndarray | None, cur: np.ndarray) -> bool:
+    if prev is None:
+        return True
+    diff = cv2.absdiff(cur, prev)
+    return np.count_nonzero(diff > MOTION_DELTA) > MOTION_MIN_PIXELS
 
-            # --- detect ---
-            boxed, raw_count = find_boxes(frame_bgr)
 
-            frame_i += 1
+def _soc_temp_c() -> float | None:
+    """SoC temperature in °C from sysfs (same sensor as `vcgencmd measure_temp`)."""
+    try:
+        with open("/sys/class/thermal/thermal_zone0/temp") as f:
+            return int(f.read()) / 1000.0
+    except (OSError, ValueError):
+        return None
 
-            # --- warm-up ignore ---
-            if frame_i <= STARTUP_WARMUP_FRAMES:
-                hits = 0
-                misses = 0
-                present = False
+
+class DetectorThread(FrameWorker):
+    """
+    Detect stage: find_boxes_gray -> warm-up + hysteresis on the freshest
+    lores Y plane from CaptureThread (stale frames are dropped while it is busy).
+    The MJPEG stream only overlays the latest result, so it runs at camera FPS
+    however long detection takes; annotations lag by at most one detect period.
+    Detection only runs on every DETECT_EVERY_N-th frame, and is skipped while
+    the scene is static (see MOTION_*); otherwise the last result is reused
+    and still feeds the hysteresis. The thread pins itself to
+    DETECT_CPUS. get() returns (boxes, raw_count, present, frame_i).
+    """
+    def __init__(self):
+        super().__init__(initial=([], 0, False, 0))
+        self.present = False
+        self.hits = 0
+        self.misses = 0
+        self.frame_i = 0
+        self.boxes, self.raw_count = [], 0
+        self.ref_thumb = None  # thumbnail of the frame find_boxes_gray last ran on
+
+    def run(self):
+        _pin_current_thread(_DETECT_CPU_SET, "Detector")
+        super().run()
+
+    def process(self, luma):
+        self.frame_i += 1
+        if self.frame_i % DETECT_EVERY_N == 0:
+            thumb = _thumb(luma)
+            if _moved(self.ref_thumb, thumb):
+                self.boxes, self.raw_count = find_boxes_gray(luma)
+                self.ref_thumb = thumb
+
+        # --- warm-up ignore ---
+        if self.frame_i <= STARTUP_WARMUP_FRAMES:
+            self.hits = 0
+            self.misses = 0
+            self.present = False
+        else:
+            # hysteresis
+            if self.raw_count > 0:
+                self.hits += 1; self.misses = 0
+                if not self.present and self.hits >= HIT_THRESHOLD:
+                    self.present = True
             else:
-                # hysteresis
-                if raw_count > 0:
-                    hits += 1; misses = 0
-                    if not present and hits >= HIT_THRESHOLD:
-                        present = True
-                else:
-                    misses += 1; hits = 0
-                    if present and misses >= MISS_THRESHOLD:
-                        present = False
-
-            # --- FPS smoothing ---
-            now = time.time()
-            fps_intervals.append(now - last_t)
-            last_t = now
-            fps = None
-            if len(fps_intervals) >= 5:
-                fps = len(fps_intervals) / max(sum(fps_intervals), 1e-6)
-
-            # --- overlays (HUD if available, else minimal text) ---
-            if 'draw_hud' in globals():
+                self.misses += 1; self.hits = 0
+                if self.present and self.misses >= MISS_THRESHOLD:
+                    self.present = False
+
+        return self.boxes, self.raw_count, self.present, self.frame_i
+
+
+class CaptureThread(threading.Thread):
+    """
+    Capture stage: pulls requests from Picamera2, publishes each main (BGR)
+    frame to `frames` for the stream consumers and submits the lores Y plane
+    to the detector. Every HEALTH_CHECK_S it logs the camera FrameDuration
+    (INFO) and a warning when the SoC runs hotter than TEMP_WARN_C.
+    """
+    def __init__(self, frames: LatestFrame, detector: FrameWorker):
+        super().__init__(daemon=True)
+        self.frames = frames
+        self.detector = detector
+        self.running = True
+
+    def run(self):
+        next_check = time.time() + HEALTH_CHECK_S
+
+        while self.running:
+            metadata = None
+            try:
+                req = picam.capture_request()
                 try:
-                    draw_hud(
-                        boxed,
-                        fps=fps,
-                        present=(1 if present else 0),
-                        raw=raw_count
-                    )
-                    if frame_i <= STARTUP_WARMUP_FRAMES:
-                        cv2.putText(boxed, "Warming up...", (16, 108),
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255,255,255), 2)
-                except Exception:
-                    # Never let HUD errors kill the stream
-                    pass
-            else:
-                if fps is not None:
-                    cv2.putText(boxed, f"FPS ~ {fps:.1f}", (10, 24),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255,255,255), 2)
-                cv2.putText(boxed, f"Boxes: {1 if present else 0}  (raw:{raw_count})",
-                            (10, 48), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255,255,255), 2)
-
-            # --- encode & yield ---
-            ok, jpg = cv2.imencode(".jpg", boxed, encode_params)
-            if not ok:
+                    # Own copies: the frames outlive the request on other threads.
+                    # Consumers must treat them as read-only.
+                    frame_bgr = req.make_array("main")
+                    yuv = req.make_array("lores")  # I420: Y plane is the first DET_H rows
+                    if time.time() >= next_check:
+                        metadata = req.get_metadata()
+                finally:
+                    req.release()
+            except Exception:
+                log.exception("capture loop error")
+                time.sleep(0.02)
                 continue
 
-            yield (b"--frame\r\n"
-                   b"Content-Type: image/jpeg\r\n\r\n" + jpg.tobytes() + b"\r\n")
+            self.frames.publish(frame_bgr)
+            self.detector.submit(yuv[:DET_H, :DET_W])
+
+            # --- periodic health check ---
+            if metadata is not None:
+                next_check = time.time() + HEALTH_CHECK_S
+                log.info("Health: FrameDuration %s us", metadata.get("FrameDuration"))
+                temp = _soc_temp_c()
+                if temp is not None and temp > TEMP_WARN_C:
+                    log.warning("SoC temperature %.1f°C; expect thermal throttling", temp)
 
-        except Exception as e:
-            # Log and keep streaming rather than 500
+
+# capture -> (detect | stream) pipeline
+frames = LatestFrame()
+det_thread = DetectorThread()
+cap_thread = CaptureThread(frames, det_thread)
+det_thread.start()
+cap_thread.start()
+
+
+class StreamEncoder(threading.Thread):
+    """
+    Stream stage, shared by every /video client: for each new captured frame
+    it overlays det_thread's latest result + HUD, encodes once and publishes
+    the JPEG to `jpegs`. Clients only wait and yield, so N viewers cost one
+    encode. Idles while no client is connected (see `clients`).
+    Any per-frame error is logged and the loop continues (no 500).
+    """
+    def __init__(self, frames: LatestFrame):
+        super().__init__(daemon=True)
+        self.frames = frames
+        self.jpegs = LatestFrame()
+        self.running = True
+        self._active = threading.Event()
+        self.clients = ClientCount(on_first=self._active.set, on_last=self._active.clear)
+
+    def run(self):
+        seq = 0
+        out = None  # drawing buffer (captured frames are shared read-only)
+        fps_meter = FpsMeter(window=15, min_samples=5)
+        fps_shown = None
+        fps_shown_t = 0.0
+
+        while self.running:
+            if not self._active.is_set():
+                # no viewers: drop the last JPEG so the next viewer doesn't
+                # start on a stale frame, sleep, and keep the idle gap out of the FPS
+                if self.jpegs.latest()[0] is not None:
+                    self.jpegs.publish(None)
+                if not self._active.wait(timeout=1.0):
+                    continue
+                fps_meter.reset()
             try:
-                log.exception("mjpeg loop error")
+                # --- next frame + overlay latest detection ---
+                frame_bgr, new_seq = self.frames.wait(seq, timeout=1.0)
+                if new_seq == seq or frame_bgr is None:
+                    continue
+                seq = new_seq
+                if out is None or out.shape != frame_bgr.shape:
+                    out = np.empty_like(frame_bgr)
+                np.copyto(out, frame_bgr)
+                boxes, raw_count, present, frame_i = det_thread.get()
+                boxed = draw_boxes(out, boxes)
+
+                # --- FPS smoothing ---
+                now = time.time()
+                fps = fps_meter.tick(now)
+                if now - fps_shown_t >= HUD_FPS_REFRESH_S:
+                    fps_shown, fps_shown_t = fps, now
+
+                # --- overlays (HUD if available, else minimal text) ---
+                if 'draw_hud' in globals():
+                    try:
+                        draw_hud(
+                            boxed,
+                            fps=fps_shown,
+                            present=(1 if present else 0),
+                            raw=raw_count,
+                            warming_up=(frame_i <= STARTUP_WARMUP_FRAMES)
+                        )
+                    except Exception:
+                        # Never let HUD errors kill the stream
+                        pass
+                else:
+                    if fps is not None:
+                        cv2.putText(boxed, f"FPS ~ {fps:.1f}", (10, 24),
+                                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255,255,255), 2)
+                    cv2.putText(boxed, f"Boxes: {1 if present else 0}  (raw:{raw_count})",
+                                (10, 48), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255,255,255), 2)
+
+                # --- encode & publish ---
+                jpg = encode_jpeg(boxed, JPEG_QUALITY)
+                if jpg is not None:
+                    self.jpegs.publish(jpg)
+
             except Exception:
-                print("mjpeg loop error:", e)
-            time.sleep(0.02)
-            continue
+                # Log and keep streaming rather than 500
+                log.exception("stream encoder error")
+                time.sleep(0.02)
+
+
+stream_enc = StreamEncoder(frames)
+stream_enc.start()
+
+def mjpeg_generator():
+    """MJPEG stream for one client: each new JPEG from stream_enc."""
+    return mjpeg_parts(stream_enc.jpegs, stream_enc.clients)
 
 
 @app.route("/")
@@ -328,13 +622,29 @@ def health():
 def video():
     return Response(mjpeg_generator(), mimetype="multipart/x-mixed-replace; boundary=frame")
 
+# /snapshot writes JPEGs off the request thread
+_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="snapshot")
+
+def _save_snapshot(orig_path, frame_bgr, det_path, boxed, count):
+    try:
+        cv2.imwrite(orig_path, frame_bgr)
+        cv2.imwrite(det_path, boxed)
+        log.info("Saved %s and %s (boxes=%d)", orig_path, det_path, count)
+    except Exception:
+        log.exception("snapshot write failed")
+
 @app.route("/snapshot")
 def snapshot():
-    """Capture one frame, save original and detected images to samples/."""
-    frame_rgb = picam.capture_array()
-    frame_bgr = cv2.cvtColor(frame_rgb, cv2.COLOR_RGB2BGR)
-
-    boxed, count = find_boxes(frame_bgr)
+    """
+    Save the latest captured frame and its detected version to samples/.
+    Reuses the live frame + detector result (no extra capture/detection pass);
+    the JPEG writes run in the background so the request returns at once.
+    """
+    frame_bgr, _ = frames.latest()
+    if frame_bgr is None:
+        return "No frame captured yet", 503
+    boxes, count, _, _ = det_thread.get()
+    boxed = draw_boxes(frame_bgr.copy(), boxes)  # captured frames are shared read-only
 
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
     base = f"capture_{ts}"
@@ -342,10 +652,7 @@ def snapshot():
     orig_path = os.path.join(SAMPLES_DIR, f"{base}_original.jpg")
     det_path  = os.path.join(SAMPLES_DIR, f"{base}_detected.jpg")
 
-    cv2.imwrite(orig_path, frame_bgr)
-    cv2.imwrite(det_path, boxed)
-
-    log.info("Saved %s and %s (boxes=%d)", orig_path, det_path, count)
+    _writer.submit(_save_snapshot, orig_path, frame_bgr, det_path, boxed, count)
     return (f"<pre>Saved:\n  samples/{os.path.basename(orig_path)}\n"
             f"  samples/{os.path.basename(det_path)}\nboxes={count}</pre>"
             "<p><a href='/video'>Back to stream</a></p>")
@@ -365,6 +672,9 @@ def config_view():
 # ---------------------- Graceful Shutdown ----------------------
 def _shutdown(*_):
     log.info("Shutting down...")
+    det_thread.running = False
+    cap_thread.running = False
+    stream_enc.running = False
     try:
         picam.stop()
     except Exception as e:
@@ -376,6 +686,4 @@ signal.signal(signal.SIGTERM, _shutdown)
 
 # --------------------------- Main ------------------------------
 if __name__ == "__main__":
-    log.info("Starting Flask server on 0.0.0.0:8000")
-    app.run(host="0.0.0.0", port=8000, threaded=True)
-
+    serve_app(app, "0.0.0.0", PORT)
@@ -7,7 +7,7 @@ Drop-in replacement for your existing Flask app that adds YOLOv8 (ONNX) inferenc
 
 Key endpoints (same as before):
   /video        → MJPEG with detection overlays
-  /video_raw    → MJPEG without detection
+  /video_raw    → MJPEG without detection (encoded by Picamera2, no HUD)
   /snapshot     → Save before/after images to samples/
   /health       → "ok"
   /config       → JSON of current settings
@@ -21,23 +21,31 @@ Notes:
 
 Author: You :)
 """
-import os, time, threading, queue, json, pathlib, math, csv, io
+import os, time, json, pathlib, math, csv, io
 from datetime import datetime
 
 import numpy as np
 import cv2
 from flask import Flask, Response, jsonify, send_file
 from picamera2 import Picamera2
+from picamera2.encoders import JpegEncoder
+from picamera2.outputs import FileOutput
 import onnxruntime as ort
 
+from frame_pipeline import (ClientCount, FpsMeter, FrameWorker, LatestFrame, MJPEG_HDR, MJPEG_TRL,
+                            encode_jpeg, mjpeg_parts, serve_app)
+
 # -----------------------------
 # CONFIG (tweak for performance)
 # -----------------------------
 CONFIG = {
     "MODEL_PATHS": [
-        "models/yolov8n_boxes.onnx",   # your fine-tuned model (preferred)
-        "models/yolov8n.onnx"          # generic COCO model (fallback)
+        "models/yolov8n_boxes_int8.onnx",  # INT8-quantised fine-tuned model (fastest)
+        "models/yolov8n_boxes.onnx",       # your fine-tuned model (preferred)
+        "models/yolov8n_int8.onnx",        # INT8-quantised COCO model
+        "models/yolov8n.onnx"              # generic COCO model (fallback)
     ],
+    "ORT_THREADS": 4,           # inference threads (Pi 3 has 4 cores)
     "INFER_SIZE": 640,          # YOLO input size
     "CONF_THRESH": 0.35,        # objectness * class_conf threshold
     "IOU_THRESH": 0.45,         # NMS IoU
@@ -81,27 +89,14 @@ def letterbox(im, new_size=640, color=(114,114,114)):
 # Utils: NMS
 # -----------------
 def nms(boxes, scores, iou_thresh=0.45):
+    """Greedy NMS on xyxy boxes; returns the indices to keep, best score first."""
     if len(boxes) == 0:
-        return []
-    boxes = boxes.astype(np.float32)
-    x1, y1, x2, y2 = boxes.T
-    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    order = scores.argsort()[::-1]
-    keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
-        xx1 = np.maximum(x1[i], x1[order[1:]])
-        yy1 = np.maximum(y1[i], y1[order[1:]])
-        xx2 = np.minimum(x2[i], x2[order[1:]])
-        yy2 = np.minimum(y2[i], y2[order[1:]])
-        w = np.maximum(0.0, xx2 - xx1 + 1)
-        h = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w * h
-        iou = inter / (areas[i] + areas[order[1:]] - inter + 1e-7)
-        inds = np.where(iou <= iou_thresh)[0]
-        order = order[inds + 1]
-    return keep
+        return np.empty(0, dtype=np.int64)
+    # cv2.dnn.NMSBoxes does the whole greedy loop in one C call; it wants xywh
+    xywh = boxes.astype(np.float32)
+    xywh[:, 2:] -= xywh[:, :2]
+    keep = cv2.dnn.NMSBoxes(xywh.tolist(), scores.astype(np.float32).tolist(), 0.0, iou_thresh)
+    return np.asarray(keep, dtype=np.int64).reshape(-1)
 
 # ---------------------------
 # YOLOv8 ONNX Inference class
@@ -120,17 +115,29 @@ class YOLOv8ONNX:
                 "See export_or_download_yolov8n_onnx.md for instructions."
             )
         self.model_path = str(model)
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
         providers = ['CPUExecutionProvider']
-        self.session = ort.InferenceSession(self.model_path, providers=providers)
+        if 'XnnpackExecutionProvider' in ort.get_available_providers():
+            # XNNPACK brings its own thread pool; keep ORT's to one thread so they don't fight
+            providers.insert(0, ('XnnpackExecutionProvider',
+                                 {"intra_op_num_threads": CONFIG["ORT_THREADS"]}))
+            opts.intra_op_num_threads = 1
+        else:
+            opts.intra_op_num_threads = CONFIG["ORT_THREADS"]
+        self.session = ort.InferenceSession(self.model_path, sess_options=opts, providers=providers)
         self.input_name = self.session.get_inputs()[0].name
         self.output_name = self.session.get_outputs()[0].name
+        # Reused NCHW input tensor (infer() only runs on the detector thread)
+        S = CONFIG["INFER_SIZE"]
+        self._input = np.empty((1, 3, S, S), np.float32)
 
     def infer(self, bgr, conf_thresh=0.3, iou_thresh=0.45, allowed_classes=None):
         # Preprocess
         img, scale, dx, dy = letterbox(bgr, CONFIG["INFER_SIZE"])
-        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        x = rgb.transpose(2,0,1).astype(np.float32) / 255.0
-        x = np.expand_dims(x, 0)
+        # BGR HWC uint8 -> RGB CHW float32 in [0,1], written straight into the input tensor
+        x = self._input
+        np.multiply(img[:, :, ::-1].transpose(2,0,1), np.float32(1 / 255.0), out=x[0])
 
         # Inference
         out = self.session.run([self.output_name], {self.input_name: x})[0]
@@ -145,11 +152,14 @@ class YOLOv8ONNX:
             out = np.squeeze(out, 0)
 
         # out: (N, 84) → [x,y,w,h, conf, 80 class probs] (COCO) or your custom classes
+        # score = obj_conf * cls_conf <= obj_conf, so drop low-objectness rows
+        # before touching the (N, classes) matrix; that is nearly all of them
+        out = out[out[:, 4] >= conf_thresh]
         boxes_xywh = out[:, :4]
         obj_conf = out[:, 4]
         cls_probs = out[:, 5:]
-        cls_ids = np.argmax(cls_probs, axis=1)
-        cls_conf = cls_probs[np.arange(cls_probs.shape[0]), cls_ids]
+        cls_ids = cls_probs.argmax(axis=1)
+        cls_conf = np.take_along_axis(cls_probs, cls_ids[:, None], axis=1)[:, 0]
         scores = obj_conf * cls_conf
 
         # Filter by class (optional) and conf
@@ -199,41 +209,23 @@ class YOLOv8ONNX:
 # ---------------------------------------------------
 # Detection worker thread (decouples cam & inference)
 # ---------------------------------------------------
-class DetectorThread(threading.Thread):
+class DetectorThread(FrameWorker):
+    """
+    Runs YOLO on the freshest submitted frame. Only every (FRAME_SKIP + 1)th
+    frame is inferred to keep the UI smooth; get() returns the last detections.
+    """
     def __init__(self, yolo, cap_size):
-        super().__init__(daemon=True)
+        super().__init__(every=CONFIG["FRAME_SKIP"] + 1, initial=[])
         self.yolo = yolo
-        self.q = queue.Queue(maxsize=1)
-        self.last_result = []
-        self.frame_count = 0
-        self.running = True
         self.cap_size = cap_size
 
-    def run(self):
-        while self.running:
-            try:
-                bgr = self.q.get(timeout=0.1)
-            except queue.Empty:
-                continue
-            self.frame_count += 1
-            if self.frame_count % (CONFIG["FRAME_SKIP"] + 1) != 0:
-                # Skip inference to keep UI smooth
-                self.last_result = self.last_result  # no change
-                continue
-            dets = self.yolo.infer(
-                bgr,
-                conf_thresh=CONFIG["CONF_THRESH"],
-                iou_thresh=CONFIG["IOU_THRESH"],
-                allowed_classes=CONFIG["ALLOWED_CLASSES"],
-            )
-            self.last_result = dets
-
-    def submit(self, bgr):
-        if not self.q.full():
-            self.q.put_nowait(bgr)
-
-    def get(self):
-        return self.last_result
+    def process(self, bgr):
+        return self.yolo.infer(
+            bgr,
+            conf_thresh=CONFIG["CONF_THRESH"],
+            iou_thresh=CONFIG["IOU_THRESH"],
+            allowed_classes=CONFIG["ALLOWED_CLASSES"],
+        )
 
 # ----------------------
 # Flask + Camera set-up
@@ -241,9 +233,38 @@ class DetectorThread(threading.Thread):
 app = Flask(__name__)
 
 picam = Picamera2()
-picam.configure(picam.create_video_configuration(main={"size": tuple(CONFIG["CAP_SIZE"])}))
+# "RGB888" is B,G,R in memory (OpenCV order), so capture_array() is BGR as-is
+picam.configure(picam.create_video_configuration(
+    main={"size": tuple(CONFIG["CAP_SIZE"]), "format": "RGB888"}))
 picam.start()
 
+class RawJpegStream(io.BufferedIOBase):
+    """
+    Source for /video_raw: Picamera2's software JpegEncoder compresses the main
+    stream on its own worker thread (in this process, so it still costs CPU)
+    and write()s each finished JPEG here; the Flask handlers only relay the
+    bytes. Clients wait on `frames`; the encoder only runs while at least one
+    client is connected (see `clients`).
+    """
+    def __init__(self, cam):
+        self.cam = cam
+        self.frames = LatestFrame()
+        self.clients = ClientCount(on_first=self._start, on_last=self._stop)
+
+    def write(self, buf):
+        self.frames.publish(buf)
+        return len(buf)
+
+    def _start(self):
+        self.cam.start_encoder(JpegEncoder(q=CONFIG["JPEG_QUALITY"]), FileOutput(self))
+
+    def _stop(self):
+        self.cam.stop_encoder()
+        # drop the last JPEG so the next viewer doesn't start on a stale frame
+        self.frames.publish(None)
+
+raw_stream = RawJpegStream(picam)
+
 # Model
 YOLO = YOLOv8ONNX(CONFIG["MODEL_PATHS"])
 det_thread = DetectorThread(YOLO, CONFIG["CAP_SIZE"])
@@ -319,59 +340,50 @@ def draw_hud(bgr, fps, box_count, present):
         y += 18
     return bgr
 
-def mjpeg_generator(annotated=True):
+
+def mjpeg_generator():
     global last_present
-    fps_win = []
-    prev = time.time()
+    fps_meter = FpsMeter(window=30)
     while True:
         frame = picam.capture_array()  # BGR
         det_thread.submit(frame)
 
-        dets = det_thread.get() if annotated else []
+        dets = det_thread.get()
         out = frame.copy()
 
-        if annotated:
-            out, box_count, now_present = annotate_and_decide(out, dets)
-            if now_present != last_present:
-                ts = int(time.time())
-                try:
-                    with open(LOG_PATH, "a", newline="") as f:
-                        csv.writer(f).writerow([ts, int(now_present)])
-                except Exception:
-                    pass
-                last_present = now_present
-        else:
-            box_count = 0
-            now_present = False
-
-        # FPS calc (cheap moving avg)
-        now = time.time()
-        fps = 1.0 / max(now - prev, 1e-6)
-        prev = now
-        fps_win.append(fps)
-        if len(fps_win) > 30:
-            fps_win.pop(0)
-        fps_smoothed = sum(fps_win) / max(len(fps_win), 1)
+        out, box_count, now_present = annotate_and_decide(out, dets)
+        if now_present != last_present:
+            ts = int(time.time())
+            try:
+                with open(LOG_PATH, "a", newline="") as f:
+                    csv.writer(f).writerow([ts, int(now_present)])
+            except Exception:
+                pass
+            last_present = now_present
+
+        # FPS over the last 30 frames
+        fps_smoothed = fps_meter.tick()
 
         # HUD
         out = draw_hud(out, fps_smoothed, box_count, now_present)
 
         # Encode JPEG
-        encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), CONFIG["JPEG_QUALITY"]]
-        ok, jpg = cv2.imencode(".jpg", out, encode_params)
-        if not ok:
+        jpg = encode_jpeg(out, CONFIG["JPEG_QUALITY"])
+        if jpg is None:
             continue
-        yield (b"--frame\r\n"
-               b"Content-Type: image/jpeg\r\n\r\n" + jpg.tobytes() + b"\r\n")
+        yield MJPEG_HDR
+        yield jpg
+        yield MJPEG_TRL
 
 @app.route("/video")
 def video():
-    return Response(mjpeg_generator(annotated=True),
+    return Response(mjpeg_generator(),
                     mimetype="multipart/x-mixed-replace; boundary=frame")
 
 @app.route("/video_raw")
 def video_raw():
-    return Response(mjpeg_generator(annotated=False),
+    # the camera's own JPEGs: no detection, no HUD
+    return Response(mjpeg_parts(raw_stream.frames, raw_stream.clients),
                     mimetype="multipart/x-mixed-replace; boundary=frame")
 
 @app.route("/snapshot")
@@ -403,13 +415,14 @@ def health():
 def cfg():
     info = dict(CONFIG)
     info["model_loaded"] = YOLO.model_path
+    info["providers"] = YOLO.session.get_providers()
     return jsonify(info)
 
 def main():
     # Prefer 0.0.0.0:8000 so you can view from your laptop/phone
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
-    app.run(host=host, port=port, threaded=True)
+    serve_app(app, host, port)
 
 if __name__ == "__main__":
     main()
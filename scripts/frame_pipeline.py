@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Threading and streaming helpers shared by box_stream.py and box_stream_yolo.py.
+
+Camera capture, detection and MJPEG encoding run on separate threads joined
+by single-slot "latest wins" hand-offs: a slow stage skips stale frames
+instead of stalling the stages around it, and HTTP clients always get the
+freshest frame. FpsMeter is the cheap per-frame FPS counter both streams use;
+encode_jpeg(), the MJPEG_* framing constants and mjpeg_parts() build the
+multipart stream, and serve_app() runs the Flask app.
+"""
+import abc
+import logging
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Optional: libjpeg-turbo via PyTurboJPEG encodes faster than cv2.imencode
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    _tj = TurboJPEG()
+except Exception:  # package not installed or libturbojpeg missing
+    _tj = None
+
+JPEG_ENCODER = "TurboJPEG" if _tj is not None else "cv2.imencode"
+
+log = logging.getLogger(__name__)
+
+# multipart framing around each JPEG; yielded as separate chunks so the
+# (30-80 KB) JPEG payload is never copied into a concatenated bytes object
+MJPEG_HDR = b"--frame\r\nContent-Type: image/jpeg\r\n\r\n"
+MJPEG_TRL = b"\r\n"
+
+# 4:2:0 chroma: a quarter of the chroma blocks of 4:4:4, visually fine for a stream
+_CV2_JPEG_FLAGS = [int(cv2.IMWRITE_JPEG_OPTIMIZE), 0]
+if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):  # OpenCV >= 4.7; match TurboJPEG's 4:2:0
+    _CV2_JPEG_FLAGS += [int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR),
+                        int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420)]
+
+
+def encode_jpeg(img: np.ndarray, quality: int) -> bytes | None:
+    """JPEG-encode a BGR frame (4:2:0); libjpeg-turbo if available, else OpenCV."""
+    if _tj is not None:
+        return _tj.encode(img, quality=quality, pixel_format=TJPF_BGR,
+                          jpeg_subsample=TJSAMP_420)
+    ok, jpg = cv2.imencode(".jpg", img, [int(cv2.IMWRITE_JPEG_QUALITY), quality] + _CV2_JPEG_FLAGS)
+    return jpg.tobytes() if ok else None
+
+
+def put_latest(q: queue.Queue, item) -> None:
+    """Put item on a maxsize=1 queue, replacing the stale item if one is waiting."""
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+class LatestFrame:
+    """
+    Single-slot broadcast: one producer publishes, any number of consumers
+    wait for something newer than what they last saw. Unlike a Queue,
+    consumers never take frames away from each other.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._value = None
+        self._seq = 0
+
+    def publish(self, value):
+        with self._cond:
+            self._value = value
+            self._seq += 1
+            self._cond.notify_all()
+
+    def latest(self):
+        """Return (value, seq) without waiting."""
+        with self._cond:
+            return self._value, self._seq
+
+    def wait(self, seen_seq: int, timeout: float | None = None):
+        """
+        Block until a value newer than seen_seq is published and return
+        (value, seq). On timeout seq == seen_seq.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq != seen_seq, timeout)
+            return self._value, self._seq
+
+
+class ClientCount:
+    """
+    Counts connected stream clients: on_first() runs when the first one
+    arrives, on_last() when the last one leaves. A client is only counted
+    once on_first() has succeeded, so if it raises, the next client retries.
+    """
+    def __init__(self, on_first=None, on_last=None):
+        self._lock = threading.Lock()
+        self._n = 0
+        self._on_first = on_first
+        self._on_last = on_last
+
+    @property
+    def count(self) -> int:
+        return self._n
+
+    def acquire(self):
+        with self._lock:
+            if self._n == 0 and self._on_first is not None:
+                self._on_first()
+            self._n += 1
+
+    def release(self):
+        with self._lock:
+            self._n -= 1
+            if self._n == 0 and self._on_last is not None:
+                self._on_last()
+
+
+def mjpeg_parts(latest: LatestFrame, clients: ClientCount | None = None):
+    """
+    MJPEG stream for one HTTP client: yields header, JPEG and trailer for
+    each new JPEG published to latest. A published None means "no current
+    frame" (producer stopped) and is skipped. With clients, the client is
+    counted from its first chunk until the response is closed (disconnect).
+    """
+    if clients is not None:
+        clients.acquire()
+    try:
+        seq = 0
+        while True:
+            jpg, new_seq = latest.wait(seq, timeout=1.0)
+            if new_seq == seq:
+                continue
+            seq = new_seq
+            if jpg is None:
+                continue
+            yield MJPEG_HDR
+            yield jpg
+            yield MJPEG_TRL
+    finally:
+        if clients is not None:
+            clients.release()
+
+
+class FrameWorker(threading.Thread, metaclass=abc.ABCMeta):
+    """
+    Daemon thread that runs process(item) on the freshest submitted item and
+    keeps the latest result for get(). submit() never blocks: an item still
+    waiting is replaced by the newer one. With every=N only every Nth item
+    is processed (the others are dropped).
+    Subclasses implement process(); its return value becomes the result.
+    """
+    def __init__(self, every: int = 1, initial=None):
+        super().__init__(daemon=True)
+        self.q = queue.Queue(maxsize=1)
+        self.lock = threading.Lock()
+        self.last_result = initial
+        self.frame_count = 0
+        self.every = max(1, int(every))
+        self.running = True
+
+    @abc.abstractmethod
+    def process(self, item):
+        """Work on one submitted item (on this thread) and return the new result."""
+
+    def run(self):
+        while self.running:
+            try:
+                item = self.q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.frame_count += 1
+            if self.frame_count % self.every != 0:
+                continue
+            try:
+                result = self.process(item)
+            except Exception:
+                # Keep the worker alive; consumers keep the previous result
+                log.exception("%s error", type(self).__name__)
+                continue
+            with self.lock:
+                self.last_result = result
+
+    def submit(self, item):
+        put_latest(self.q, item)
+
+    def get(self):
+        with self.lock:
+            return self.last_result
+
+
+class FpsMeter:
+    """
+    Frame rate over the last `window` frame intervals, kept in a fixed
+    float32 ring buffer with a running sum so each tick is O(1).
+    tick() returns None until min_samples intervals have been seen.
+    """
+    def __init__(self, window: int = 15, min_samples: int = 1):
+        self._buf = np.zeros(window, np.float32)
+        self.min_samples = min_samples
+        self.reset()
+
+    def reset(self):
+        """Forget all intervals (e.g. after an idle gap); timing restarts now."""
+        self._buf[:] = 0
+        self._i = 0
+        self._n = 0
+        self._sum = 0.0
+        self._last = time.time()
+
+    def tick(self, now: float | None = None) -> float | None:
+        now = time.time() if now is None else now
+        dt = np.float32(now - self._last)
+        self._last = now
+        self._sum += float(dt) - float(self._buf[self._i])
+        self._buf[self._i] = dt
+        self._i = (self._i + 1) % len(self._buf)
+        self._n = min(self._n + 1, len(self._buf))
+        if self._n < self.min_samples:
+            return None
+        return self._n / max(self._sum, 1e-6)
+
+
+def serve_app(app, host: str, port: int) -> None:
+    """Serve the Flask app with waitress if it is installed, else the Flask dev server."""
+    try:
+        from waitress import serve
+    except ImportError:  # optional; fall back to the Flask dev server
+        log.info("Starting Flask server on %s:%d", host, port)
+        app.run(host=host, port=port, threaded=True)
+        return
+    # each MJPEG viewer holds one worker thread for as long as it watches
+    log.info("Starting waitress on %s:%d", host, port)
+    serve(app, host=host, port=port, threads=8, channel_timeout=3600)